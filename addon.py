@@ -3,25 +3,38 @@ from __future__ import unicode_literals, division, print_function, absolute_impo
 
 import sys
 import os.path
-import json
 import random
+import sqlite3
+import threading
 import time
 import traceback
+from contextlib import contextmanager
 
 from kodi_six import xbmc, xbmcaddon, xbmcgui, xbmcplugin, py2_decode, py2_encode
 
+from resources.lib.breaker import CircuitBreaker
+from resources.lib.cache import Cache, project_categories, project_languages, project_media_items
+from resources.lib.client import ApiClient
 from resources.lib.constants import Query as Q, Mode as M, SettingID, LocalizedStringID
 from resources.lib.constants import CATEGORY_URL, LANGUAGE_URL, MEDIA_URL, SEARCH_URL, TOKEN_URL, TRANSLATION_URL
+from resources.lib.constants import CACHE_TTL, LANGUAGE_CACHE_TTL, STALE_TTL, SUBTITLE_CACHE_SIZE, SUBTITLE_WAIT
+from resources.lib.constants import WIDGET_CATEGORIES, WIDGET_LIMIT, SEARCH_LIMIT, SEARCH_EXTRA_WAIT
+from resources.lib.index import SearchIndex
+from resources.lib.kodiutils import translate_path
+from resources.lib.lock import FileLock
+from resources.lib.media import category_url, preferred_media_file
+from resources.lib.policy import Fetcher, LatencyHistogram
+from resources.lib.subtitles import SubtitleCache
 
 try:
     from urllib.error import HTTPError, URLError
-    from urllib.request import urlopen, Request
+    from urllib.request import Request
     from urllib.parse import parse_qs, urlencode
     from time import strftime
 
 except ImportError:
     from urlparse import parse_qs as _parse_qs
-    from urllib2 import urlopen, Request, HTTPError, URLError
+    from urllib2 import Request, HTTPError, URLError
     from urllib import urlencode as _urlencode
     from time import strftime as _strftime
 
@@ -245,34 +258,8 @@ class Media(Directory):
     def get_preferred_media_file(data):
         """Take an jw JSON array of files and metadata and return the most suitable like (url, size, subtitles)"""
 
-        # Rank media files depending on how they match certain criteria
-        # Video resolution will be converted to a rank between 2 and 10
-        resolution_not_too_big = 200
-        subtitles_matches_pref = 100
-
-        files = []
-        for f in data:
-            rank = 0
-            try:
-                # Grab resolution from label, eg. 360p, and remove the p
-                res = int(f.get('label')[:-1])
-            except (TypeError, ValueError):
-                try:
-                    res = int(f.get('frameHeight', 0))
-                except (TypeError, ValueError):
-                    res = 0
-            rank += res // 10
-            if 0 < res <= video_res:
-                rank += resolution_not_too_big
-            # 'subtitled' only applies to hardcoded video subtitles
-            if f.get('subtitled') == subtitle_setting:
-                rank += subtitles_matches_pref
-            files.append((rank, f))
-        files.sort()
-
-        if len(files) > 0:
-            # [-1] The file with the highest rank, [1] the filename, not the rank
-            f = files[-1][1]
+        f = preferred_media_file(data, video_res, subtitle_setting)
+        if f:
             return f['progressiveDownloadURL'], f['filesize'], getitem(f, 'subtitles', 'url', default=None)
         else:
             return None, None, None
@@ -384,24 +371,26 @@ def get_json(url, ignore_errors=False, catch_401=True):
 
     :param url: URL to open or a Request object
     :param ignore_errors: IO exceptions will only be logged, don't exit
-    :param catch_401: If False HTTP 401 will be passed on instead of caught
+    :param catch_401: If False HTTP 401 will be passed on instead of caught (even with ignore_errors)
 
     IF an IO exception occurs a message will be displayed and the script exits.
+    Hosts that keep failing are skipped for a while (see CircuitBreaker), which counts as an IO exception.
     """
     if isinstance(url, Request):
-        log('opening {}'.format(url.get_full_url()), xbmc.LOGINFO)
+        full_url = url.get_full_url()
     else:
-        log('opening {}'.format(url), xbmc.LOGINFO)
+        full_url = url
+    log('opening {}'.format(full_url), xbmc.LOGINFO)
 
     try:
-        data = urlopen(url).read().decode('utf-8')  # urlopen returns bytes
+        return client.get_json(url)
     # Catches URLError, HTTPError, SSLError ...
     except IOError as e:
-        if ignore_errors:
+        if not catch_401 and isinstance(e, HTTPError) and e.code == 401:
+            raise
+        elif ignore_errors:
             log(traceback.format_exc(), level=xbmc.LOGWARNING)
             return None
-        elif not catch_401 and isinstance(e, HTTPError) and e.code == 401:
-            raise
         else:
             log(traceback.format_exc(), level=xbmc.LOGERROR)
             xbmcgui.Dialog().notification(
@@ -412,7 +401,69 @@ def get_json(url, ignore_errors=False, catch_401=True):
             exit()
             raise  # to make PyCharm happy
 
-    return json.loads(data)
+
+def get_cached_json(url, projection, max_age=CACHE_TTL, **kwargs):
+    """Like get_json, but use the local cache when possible
+
+    :param url: URL to open
+    :param projection: function that strips the data down to the fields we use, before it's stored
+    :param max_age: seconds before the cached data should be refreshed
+    :param kwargs: passed on to get_json
+
+    Cached data older than max_age is still returned right away, and refreshed in the background.
+    Data older than STALE_TTL is fetched right away, but if that fails it's still better than nothing.
+    Note: the returned data is always projected, even if the cache couldn't be written
+    """
+    data, age = cache.read(url)
+    if data is not None:
+        if age <= max_age:
+            return data
+        if age <= STALE_TTL:
+            refresh_in_background(url, projection)
+            return data
+
+        fresh_data = fetch_and_cache(url, projection, ignore_errors=True)
+        if fresh_data is None:
+            show_offline_notice()
+            return data
+        return fresh_data
+
+    return fetch_and_cache(url, projection, **kwargs)
+
+
+def fetch_and_cache(url, projection, **kwargs):
+    """Fetch JSON data, project it, and store it in the cache (see ApiClient.fetch_and_cache)
+
+    :param kwargs: passed on to get_json
+    """
+    return client.fetch_and_cache(url, projection, get_json=lambda u: get_json(u, **kwargs))
+
+
+def refresh_in_background(url, projection):
+    """Refresh a cache entry in a separate thread
+
+    The threads are joined at the end of the script, when the listing is already visible.
+    If the refresh fails, the user is told that the listing is showing saved data.
+    """
+    if url in background_refreshes:
+        return
+    def refresh():
+        if fetch_and_cache(url, projection, ignore_errors=True) is None:
+            show_offline_notice()
+
+    log('refreshing {} in background'.format(url))
+    thread = threading.Thread(target=refresh)
+    thread.start()
+    background_refreshes[url] = thread
+
+
+def show_offline_notice():
+    """Let the user know that the network failed, and that we're showing old data (only once)"""
+
+    global offline
+    if not offline:
+        offline = True
+        xbmcgui.Dialog().notification(addon.getAddonInfo('name'), S.OFFLINE, icon=xbmcgui.NOTIFICATION_WARNING)
 
 
 def top_level_page():
@@ -426,25 +477,29 @@ def top_level_page():
             dialog.textviewer(S.THEO_WARN, S.DISCLAIMER)  # Kodi v16
         except AttributeError:
             dialog.ok(S.THEO_WARN, S.DISCLAIMER)
-        addon.setSetting(SettingID.START_WARNING, 'false')
+        with locked_settings() as settings:
+            settings.setSetting(SettingID.START_WARNING, 'false')
 
     # Auto language
     isolang = xbmc.getLanguage(xbmc.ISO_639_1)
-    if not addon.getSetting(SettingID.LANG_HIST):
-        # Write English to language history, so this code only runs once
-        addon.setSetting(SettingID.LANG_HIST, 'E')
-        # If Kodi is in foreign language
-        if isolang != 'en':
-            data = get_json(LANGUAGE_URL + 'E/web')
-            for l in data['languages']:
-                if l['locale'] == isolang:
-                    # Save setting, and update for this this instance
-                    set_language(l['code'], l['name'] + ' / ' + l['vernacular'])
-                    global global_lang
-                    global_lang = addon.getSetting(SettingID.LANGUAGE) or 'E'
-                    break
-
-    data = get_json(CATEGORY_URL + global_lang + '?detailed=True')
+    with locked_settings() as settings:
+        # Check again, another process may have done this already
+        first_run = not settings.getSetting(SettingID.LANG_HIST)
+        if first_run:
+            # Write English to language history, so this code only runs once
+            settings.setSetting(SettingID.LANG_HIST, 'E')
+    # If Kodi is in foreign language
+    if first_run and isolang != 'en':
+        data = get_cached_json(LANGUAGE_URL + 'E/web', project_languages, max_age=LANGUAGE_CACHE_TTL)
+        for l in data['languages']:
+            if l['locale'] == isolang:
+                # Save setting, and update for this this instance
+                set_language(l['code'], l['name'] + ' / ' + l['vernacular'])
+                global global_lang
+                global_lang = l['code'] or 'E'
+                break
+
+    data = get_cached_json(CATEGORY_URL + global_lang + '?detailed=True', project_categories)
 
     for c in data['categories']:
         d = Directory(fanart=default_fanart)
@@ -458,7 +513,8 @@ def top_level_page():
     if not search_label:
         data = get_json(TRANSLATION_URL + global_lang, ignore_errors=True)
         search_label = getitem(data, 'translations', global_lang, 'hdgSearch', default='Search')
-        addon.setSetting(SettingID.SEARCH_TRANSL, search_label)
+        with locked_settings() as settings:
+            settings.setSetting(SettingID.SEARCH_TRANSL, search_label)
     d = Directory(url=request_to_self({Q.MODE: M.SEARCH}), title=search_label, fanart=default_fanart,
                   icon='DefaultMusicSearch.png')
     d.add_item_in_kodi()
@@ -469,12 +525,10 @@ def top_level_page():
 def sub_level_page(sub_level):
     """A sub-level page with either folders or playable media"""
 
-    # TODO: less detailed request?
-    #  For categories like VODStudio that contains subcategories with media,
-    #  all media is included in the response, which slows down the parsing a lot.
-    #  All this extra data has no function in this script. If there only was a way
-    #  to request the subcategories, but without their media...
-    data = get_json(CATEGORY_URL + global_lang + '/' + sub_level + '?&detailed=1')
+    # Note: for categories like VODStudio that contains subcategories with media,
+    #  all media is included in the response. The cache only keeps the fields we use,
+    #  so it's only the first load that has to parse all that extra data.
+    data = get_cached_json(category_url(global_lang, sub_level), project_categories)
     data = data['category']
 
     # Enable more viewtypes
@@ -497,10 +551,40 @@ def sub_level_page(sub_level):
     xbmcplugin.endOfDirectory(addon_handle)
 
 
+def widget_page(mode):
+    """A short list of media for skin widgets, only from cached data
+
+    Skins reload widgets all the time, so this never touches the network.
+    The service keeps the cache up to date instead.
+    """
+    data = cache.load(category_url(global_lang, WIDGET_CATEGORIES[mode]))
+    xbmcplugin.setContent(addon_handle, 'videos')
+
+    if data:
+        category = data.get('category', {})
+        all_media = category.get('media', [])
+        for sc in category.get('subcategories', []):
+            all_media = all_media + sc.get('media', [])
+
+        count = 0
+        for md in all_media:
+            if count >= WIDGET_LIMIT:
+                break
+            m = Media()
+            m.parse_media(md, censor_hidden=False)
+            if m.url and not m.hidden:
+                m.add_item_in_kodi()
+                count += 1
+    else:
+        log('no cached data for widget {}, waiting for the service'.format(mode), xbmc.LOGINFO)
+
+    xbmcplugin.endOfDirectory(addon_handle)
+
+
 def shuffle_category(key):
     """Generate a shuffled playlist and start playing"""
 
-    data = get_json(CATEGORY_URL + global_lang + '/' + key + '?&detailed=1')
+    data = get_cached_json(category_url(global_lang, key), project_categories)
     data = data['category']
     all_media = data.get('media', [])
     for sc in data.get('subcategories', []):  # type: dict
@@ -529,7 +613,7 @@ def language_dialog(media_key=None):
     :param media_key: play this media file instead of changing global setting
     """
     # Note: the list from jw.org is already sorted by ['name']
-    data = get_json(LANGUAGE_URL + global_lang + '/web')
+    data = get_cached_json(LANGUAGE_URL + global_lang + '/web', project_languages, max_age=LANGUAGE_CACHE_TTL)
     # Convert language data to a list of tuples with (code, name)
     languages = [(l.get('code'), l.get('name', '') + ' / ' + l.get('vernacular', ''))
                  for l in data['languages']]
@@ -540,7 +624,7 @@ def language_dialog(media_key=None):
     if media_key:
         # Lookup media, and only show available languages
         url = MEDIA_URL + global_lang + '/' + media_key
-        data = get_json(url)
+        data = get_cached_json(url, project_media_items)
         available_langs = data['media'][0].get('availableLanguages')
         if available_langs:
             languages = [l for l in languages if l[0] in available_langs]
@@ -570,25 +654,40 @@ def language_dialog(media_key=None):
 def set_language(lang, name):
     """Save a language to setting and history"""
 
-    addon.setSetting(SettingID.LANGUAGE, lang)
-    addon.setSetting(SettingID.LANG_NAME, name)
+    with locked_settings() as settings:
+        settings.setSetting(SettingID.LANGUAGE, lang)
+        settings.setSetting(SettingID.LANG_NAME, name)
+        # Forget about the translation of "Search"
+        settings.setSetting(SettingID.SEARCH_TRANSL, '')
     save_language_history(lang)
-    # Forget about the translation of "Search"
-    addon.setSetting(SettingID.SEARCH_TRANSL, '')
 
 
 def save_language_history(lang):
     """Save a language code first in history"""
 
-    history = addon.getSetting(SettingID.LANG_HIST).split()
-    history = [lang] + [h for h in history if h != lang]
-    history = history[0:5]
-    addon.setSetting(SettingID.LANG_HIST, ' '.join(history))
+    with locked_settings() as settings:
+        history = settings.getSetting(SettingID.LANG_HIST).split()
+        history = [lang] + [h for h in history if h != lang]
+        history = history[0:5]
+        settings.setSetting(SettingID.LANG_HIST, ' '.join(history))
+
+
+@contextmanager
+def locked_settings():
+    """Change settings without interfering with other processes
+
+    Yields a new Addon object, because the one from startup may have old settings,
+    and saving those would undo what other processes have changed.
+    """
+    with FileLock(os.path.join(profile_dir, 'settings.lock')):
+        yield xbmcaddon.Addon()
 
 
 def search_page():
-    """Display a search dialog, then the results"""
+    """Display a search dialog, then the results
 
+    Results come from the local index first, and are filled up with results from jw.org
+    """
     kb = xbmc.Keyboard()
     kb.doModal()
     if kb.isConfirmed():
@@ -596,43 +695,112 @@ def search_page():
         xbmcplugin.setContent(addon_handle, 'videos')
 
         search_string = kb.getText()
-        query = urlencode({'q': search_string, 'lang': global_lang, 'limit': 24})
 
         try:
-            token = addon.getSetting(SettingID.TOKEN)
-            if not token:
-                raise RuntimeError
-
-            headers = {'Authorization': 'Bearer ' + token}
-            data = get_json(Request(SEARCH_URL + '?' + query, headers=headers), catch_401=False)
-
-        except (HTTPError, RuntimeError):
-            # Get and save new token
-            log('requesting new authentication token from jw.org', xbmc.LOGINFO)
-            token = urlopen(TOKEN_URL).read().decode('utf-8')
-            if not token:
-                raise RuntimeError('failed to get search authentication token')
+            index = SearchIndex(os.path.join(profile_dir, 'search.db'))
+            try:
+                local_results = index.search(search_string, global_lang, SEARCH_LIMIT)
+            finally:
+                index.close()
+        except sqlite3.Error:
+            log(traceback.format_exc(), level=xbmc.LOGWARNING)
+            local_results = []
 
-            addon.setSetting(SettingID.TOKEN, token)
+        keys = set()
+        for md in local_results:
+            media = Media()
+            media.parse_media(md, censor_hidden=False)
+            if media.url and not media.hidden:
+                media.add_item_in_kodi()
+                keys.add(media.key)
 
-            headers = {'Authorization': 'Bearer ' + token}
-            data = get_json(Request(SEARCH_URL + '?' + query, headers=headers))
+        if not keys:
+            data = remote_search(search_string)
+        elif len(keys) < SEARCH_LIMIT:
+            # If we have something to show, don't let the network get in the way
+            data = start_remote_search(search_string)()
+        else:
+            data = None
 
-        for hd in data['hits']:
+        for hd in getitem(data, 'hits', default=[]):
+            if len(keys) >= SEARCH_LIMIT:
+                break
             media = Media()
             media.parse_hits(hd)
-            if media.url:
+            if media.url and media.key not in keys:
                 media.add_item_in_kodi()
+                keys.add(media.key)
 
         xbmcplugin.endOfDirectory(addon_handle)
 
 
+def start_remote_search(search_string):
+    """Run remote_search in a thread, and return a function that waits SEARCH_EXTRA_WAIT seconds for the result
+
+    Network errors are only logged. If jw.org is too slow, the waiting function returns None,
+    and the search finishes before the script exits, so a renewed token is there next time.
+    """
+    result = []
+    thread = threading.Thread(target=lambda: result.append(remote_search(search_string, ignore_errors=True)))
+    thread.start()
+    background_tasks.append(thread)
+
+    def wait():
+        thread.join(SEARCH_EXTRA_WAIT)
+        return result[0] if result else None
+
+    return wait
+
+
+def remote_search(search_string, ignore_errors=False):
+    """Query the search API of jw.org, and get a new authentication token if needed
+
+    :param ignore_errors: IO exceptions will only be logged, and None returned
+    """
+    query = urlencode({'q': search_string, 'lang': global_lang, 'limit': SEARCH_LIMIT})
+
+    try:
+        token = addon.getSetting(SettingID.TOKEN)
+        if not token:
+            raise RuntimeError
+
+        headers = {'Authorization': 'Bearer ' + token}
+        return get_json(Request(SEARCH_URL + '?' + query, headers=headers), ignore_errors=ignore_errors,
+                        catch_401=False)
+
+    except (HTTPError, RuntimeError):
+        # Only one process at a time gets a new token, the others wait and use it
+        with FileLock(os.path.join(profile_dir, 'token.lock'), timeout=20):
+            new_token = xbmcaddon.Addon().getSetting(SettingID.TOKEN)
+            if new_token and new_token != token:
+                log('using authentication token from another process')
+                token = new_token
+            else:
+                # Get and save new token
+                log('requesting new authentication token from jw.org', xbmc.LOGINFO)
+                try:
+                    token = fetcher.fetch(TOKEN_URL).decode('utf-8')
+                except IOError:
+                    if ignore_errors:
+                        log(traceback.format_exc(), level=xbmc.LOGWARNING)
+                        return None
+                    raise
+                if not token:
+                    raise RuntimeError('failed to get search authentication token')
+
+                with locked_settings() as settings:
+                    settings.setSetting(SettingID.TOKEN, token)
+
+        headers = {'Authorization': 'Bearer ' + token}
+        return get_json(Request(SEARCH_URL + '?' + query, headers=headers), ignore_errors=ignore_errors)
+
+
 def hidden_media_dialog(media_key):
     """Ask the user for permission, then create a folder with a single media entry"""
 
     dialog = xbmcgui.Dialog()
     if dialog.yesno(S.HIDDEN, S.CONV_QUESTION):
-        data = get_json(MEDIA_URL + global_lang + '/' + media_key)
+        data = get_cached_json(MEDIA_URL + global_lang + '/' + media_key, project_media_items)
         media = Media()
         media.parse_media(data['media'][0], censor_hidden=False)
         if media.url:
@@ -654,19 +822,26 @@ def resolve_media(media_key, lang=None):
         # If we were called with a language, remove it from the URI and make a new request
         # This will make watched status and resume position language agnostic
         save_language_history(lang)
-        addon.setSetting(SettingID.LANG_NEXT, lang)
+        with locked_settings() as settings:
+            settings.setSetting(SettingID.LANG_NEXT, lang)
         xbmc.executebuiltin('PlayMedia({}, resume)'.format(request_to_self({Q.MODE: M.PLAY, Q.MEDIAKEY: media_key})))
         return
 
     one_time_lang = addon.getSetting(SettingID.LANG_NEXT)
 
-    data = get_json(MEDIA_URL + (one_time_lang or global_lang) + '/' + media_key)
+    # When playing in another language, we'll want subtitles from the global language, start looking right away
+    if one_time_lang and one_time_lang != global_lang:
+        wait_for_global_subs = start_subtitle_download(media_key, global_lang)
+    else:
+        wait_for_global_subs = None
+
+    data = get_cached_json(MEDIA_URL + (one_time_lang or global_lang) + '/' + media_key, project_media_items)
 
     # If set to always use foreign language, it may try to play a video in a language where it doesn't exist
     # this does not happen when using the one-time language menu, because it looks up languages on individual videos
     if one_time_lang and not data.get('media', None):
         xbmcgui.Dialog().notification(addon.getAddonInfo('name'), S.NOT_AVAIL, icon=xbmcgui.NOTIFICATION_WARNING)
-        data = get_json(MEDIA_URL + global_lang + '/' + media_key)
+        data = get_cached_json(MEDIA_URL + global_lang + '/' + media_key, project_media_items)
         one_time_lang = None
 
     media = Media()
@@ -674,14 +849,15 @@ def resolve_media(media_key, lang=None):
 
     if one_time_lang:
         if addon.getSetting(SettingID.REMEMBER_LANG) == 'false':
-            addon.setSetting(SettingID.LANG_NEXT, None)
+            with locked_settings() as settings:
+                settings.setSetting(SettingID.LANG_NEXT, None)
 
-        if one_time_lang != global_lang:
-            # Add subtitles from the global language too
-            data = get_json(MEDIA_URL + global_lang + '/' + media_key, ignore_errors=True)
-            global_lang_subs = getitem(data, 'media', 0, 'files', 0, 'subtitles', 'url', default=None)
-            if global_lang_subs:
-                media.subtitles = global_lang_subs
+    # Subtitles from the global language are preferred, those of the media file only if there are none
+    global_lang_subs = wait_for_global_subs() if wait_for_global_subs and one_time_lang else None
+    if global_lang_subs:
+        media.subtitles = global_lang_subs
+    elif media.subtitles:
+        media.subtitles = start_subtitle_download(media_key, one_time_lang or global_lang, media.subtitles)()
 
     if media.resolved_url:
         xbmcplugin.setResolvedUrl(addon_handle, succeeded=True, listitem=media.listitem_with_resolved_url())
@@ -699,6 +875,58 @@ def resolve_media(media_key, lang=None):
         raise RuntimeError
 
 
+def find_subtitles(media_key, lang):
+    """Return the subtitle URL of a media item in a language, or None if it has none"""
+
+    data = get_cached_json(MEDIA_URL + lang + '/' + media_key, project_media_items, ignore_errors=True)
+    return getitem(data, 'media', 0, 'files', 0, 'subtitles', 'url', default=None)
+
+
+def download_subtitles(media_key, lang, url):
+    """Return the path to a local copy of subtitles, or None if the download fails"""
+
+    try:
+        return subtitle_cache.download(media_key, lang, url, fetcher.fetch)
+    except (IOError, OSError):
+        log(traceback.format_exc(), level=xbmc.LOGWARNING)
+        return None
+
+
+def start_subtitle_download(media_key, lang, url=None):
+    """Look up and download subtitles in a thread, and return a function that waits for the result
+
+    :param url: URL of the subtitles, if None it is looked up in the media data for the language
+
+    The waiting function returns None if there are no subtitles. It waits for the lookup, which is normally cached,
+    but only SUBTITLE_WAIT seconds for the download, enough for a file that's already stored.
+    After that it returns the remote URL, and the download finishes before the script exits, so it's there next time.
+    """
+    result = {'url': url}
+    found = threading.Event()
+
+    def run():
+        try:
+            if not result['url']:
+                result['url'] = find_subtitles(media_key, lang)
+        finally:
+            found.set()
+        if result['url']:
+            result['path'] = download_subtitles(media_key, lang, result['url'])
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    background_tasks.append(thread)
+
+    def wait():
+        found.wait()
+        if not result['url']:
+            return None
+        thread.join(SUBTITLE_WAIT)
+        return result.get('path') or result['url']
+
+    return wait
+
+
 def request_to_self(query):
     """Return a string with an URL request to the add-on itself"""
 
@@ -715,6 +943,22 @@ if __name__ == '__main__':
     addon_id = addon.getAddonInfo('id')
     # To to get translated strings
     S = LocalizedStringID(addon.getLocalizedString)
+    # Projected API responses
+    profile_dir = translate_path(addon.getAddonInfo('profile'))
+    cache = Cache(os.path.join(profile_dir, 'cache'))
+    subtitle_cache = SubtitleCache(os.path.join(profile_dir, 'subtitles'), SUBTITLE_CACHE_SIZE)
+    breaker = CircuitBreaker(os.path.join(profile_dir, 'breaker.json'))
+    # Timeouts, retries and response time statistics
+    histogram = LatencyHistogram(os.path.join(profile_dir, 'latency.json'))
+    fetcher = Fetcher(histogram, log=log)
+    # Requests through the breaker and the cache
+    client = ApiClient(cache, breaker, fetcher, log=log)
+    # Threads refreshing stale cache entries, by URL
+    background_refreshes = {}
+    # Threads downloading subtitles or searching, they may start background refreshes too
+    background_tasks = []
+    # Set when stale data has been shown because of network problems
+    offline = False
 
     video_res = [1080, 720, 480, 360, 240][int(addon.getSetting(SettingID.RESOLUTION))]
     subtitle_setting = addon.getSetting(SettingID.SUBTITLES) == 'true'
@@ -732,24 +976,40 @@ if __name__ == '__main__':
 
     mode = args.get(Q.MODE)
 
-    if mode is None:
-        top_level_page()
-    elif mode == M.LANGUAGES:
-        language_dialog(args.get(Q.MEDIAKEY))
-    elif mode == M.SET_LANG:
-        set_language(args[Q.LANGCODE], args[Q.LANGNAME])
-    elif mode == M.HIDDEN:
-        hidden_media_dialog(args[Q.MEDIAKEY])
-    elif mode == M.SEARCH:
-        search_page()
-    elif mode == M.PLAY:
-        resolve_media(args[Q.MEDIAKEY], args.get(Q.LANGCODE))
-    elif mode == M.BROWSE:
-        sub_level_page(args[Q.CATKEY])
-    elif mode == M.STREAM:
-        shuffle_category(args[Q.STREAMKEY])
-    # Backwards compatibility
-    elif mode.startswith('Streaming') and mode != 'Streaming':
-        shuffle_category(mode)
-    else:
-        sub_level_page(mode)
+    try:
+        if mode is None:
+            top_level_page()
+        elif mode == M.LANGUAGES:
+            language_dialog(args.get(Q.MEDIAKEY))
+        elif mode == M.SET_LANG:
+            set_language(args[Q.LANGCODE], args[Q.LANGNAME])
+        elif mode == M.HIDDEN:
+            hidden_media_dialog(args[Q.MEDIAKEY])
+        elif mode == M.SEARCH:
+            search_page()
+        elif mode == M.PLAY:
+            resolve_media(args[Q.MEDIAKEY], args.get(Q.LANGCODE))
+        elif mode == M.BROWSE:
+            sub_level_page(args[Q.CATKEY])
+        elif mode == M.STREAM:
+            shuffle_category(args[Q.STREAMKEY])
+        elif mode in (M.LATEST, M.FEATURED):
+            widget_page(mode)
+        # Backwards compatibility
+        elif mode.startswith('Streaming') and mode != 'Streaming':
+            shuffle_category(mode)
+        else:
+            sub_level_page(mode)
+
+        # Let background work finish, now that the user has something to look at
+        for t in background_tasks:
+            t.join()
+        for t in list(background_refreshes.values()):
+            t.join()
+
+    finally:
+        # Response times are saved once per invocation, also when get_json exits
+        histogram.save()
+
+    # For tuning the timeouts in policy.py
+    log('response times:\n' + histogram.summary())
@@ -0,0 +1,101 @@
+"""
+A circuit breaker that remembers failing hosts between plugin invocations
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import time
+
+from .files import atomic_write
+from .lock import FileLock
+
+
+class CircuitOpenError(IOError):
+    """Raised instead of making a request to a host that is known to be failing"""
+
+    def __init__(self, host):
+        super(CircuitOpenError, self).__init__('too many failures, not contacting ' + host)
+        self.host = host
+
+
+class CircuitBreaker(object):
+    def __init__(self, path, threshold=3, cooldown=30):
+        """Keep track of failures per host in a small JSON file
+
+        :param path: file to store the state in, since every click in Kodi is a new process
+        :param threshold: number of failures in a row before the host is skipped
+        :param cooldown: seconds to skip the host, before one new attempt is allowed
+
+        The state of each host is [failures, skip until, time of the last attempt after the cooldown].
+        """
+        self.path = path
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def _lock(self):
+        # The file is shared by all processes, only a few milliseconds of work is done while holding it,
+        # so a lock that hasn't been touched for a couple of seconds was left by a killed process
+        return FileLock(self.path + '.lock', timeout=5, stale=2)
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, state):
+        try:
+            atomic_write(self.path, json.dumps(state), 'w')
+        except (IOError, OSError):
+            # Not worth crashing over, we'll just make some extra requests
+            pass
+
+    @staticmethod
+    def _get(state, host):
+        """Return the state of a host, also from files written by older versions"""
+
+        values = list(state.get(host, ()))
+        return (values + [0, 0, 0][len(values):])[:3]
+
+    def allow(self, host):
+        """Return False if requests to this host should be skipped for now
+
+        When the cooldown is over, only the first caller is let through, to see if the host is back.
+        The others are skipped until that attempt succeeds, or until another cooldown has passed without an answer.
+        """
+        with self._lock():
+            state = self._read()
+            failures, open_until, probe_at = self._get(state, host)
+            if failures < self.threshold:
+                return True
+            now = time.time()
+            if now < open_until or now < probe_at + self.cooldown:
+                return False
+            state[host] = (failures, open_until, now)
+            self._write(state)
+            return True
+
+    def success(self, host):
+        """Reset the failure count of a host"""
+
+        with self._lock():
+            state = self._read()
+            if host in state:
+                del state[host]
+                self._write(state)
+
+    def failure(self, host):
+        """Count a failure, and open the circuit if there were too many
+
+        If the attempt after the cooldown fails too, the circuit opens again right away.
+        """
+        with self._lock():
+            state = self._read()
+            failures, open_until, probe_at = self._get(state, host)
+            failures += 1
+            if failures >= self.threshold:
+                open_until = time.time() + self.cooldown
+                probe_at = 0
+            state[host] = (failures, open_until, probe_at)
+            self._write(state)
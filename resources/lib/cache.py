@@ -0,0 +1,181 @@
+"""
+A local store for API responses, stripped down to the fields the add-on actually reads
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+import marshal
+import os
+import time
+
+from .files import atomic_write
+from .lock import FileLock
+
+# Bump this when the projections change, so that old cache files are ignored
+FORMAT_VERSION = 2
+
+# Only these tags affect how an item is displayed, all other tags are dropped
+KNOWN_TAGS = ('AppleTVExclude', 'StreamThisChannelEnabled', 'AllowShuffleInCategoryHeader')
+# Image types and sizes that Directory.parse_common looks for
+IMAGE_TYPES = ('sqr', 'cvr', 'wsr', 'lsr', 'pnr')
+IMAGE_SIZES = ('lg', 'md')
+
+COMMON_FIELDS = ('description',)
+CATEGORY_FIELDS = ('key', 'name', 'type')
+MEDIA_FIELDS = ('languageAgnosticNaturalKey', 'title', 'type', 'duration', 'firstPublished')
+FILE_FIELDS = ('label', 'frameHeight', 'subtitled', 'progressiveDownloadURL', 'filesize')
+LANGUAGE_FIELDS = ('code', 'name', 'vernacular', 'locale')
+
+
+def pick(data, fields):
+    """Return a new dict with only the given fields (those that exist)"""
+
+    return {f: data[f] for f in fields if f in data}
+
+
+def project_common(data):
+    """Metadata read by Directory.parse_common"""
+
+    result = pick(data, COMMON_FIELDS)
+    if 'tags' in data:
+        result['tags'] = [t for t in data['tags'] if t in KNOWN_TAGS]
+    images = data.get('images')
+    if isinstance(images, dict):
+        result['images'] = {t: pick(images[t], IMAGE_SIZES)
+                            for t in IMAGE_TYPES if isinstance(images.get(t), dict)}
+    return result
+
+
+def project_file(data):
+    """Metadata read by Media.get_preferred_media_file"""
+
+    result = pick(data, FILE_FIELDS)
+    if isinstance(data.get('subtitles'), dict) and 'url' in data['subtitles']:
+        result['subtitles'] = {'url': data['subtitles']['url']}
+    return result
+
+
+def project_media(data):
+    """Metadata read by Media.parse_media"""
+
+    result = project_common(data)
+    result.update(pick(data, MEDIA_FIELDS))
+    if 'files' in data:
+        result['files'] = [project_file(f) for f in data['files']]
+    return result
+
+
+def project_category(data):
+    """Metadata read by Directory.parse_category, including subcategories and media"""
+
+    result = project_common(data)
+    result.update(pick(data, CATEGORY_FIELDS))
+    if 'subcategories' in data:
+        result['subcategories'] = [project_category(sc) for sc in data['subcategories']]
+    if 'media' in data:
+        result['media'] = [project_media(md) for md in data['media']]
+    return result
+
+
+def project_categories(data):
+    """Projection for CATEGORY_URL responses, both the top level and sub levels"""
+
+    result = {}
+    if 'category' in data:
+        result['category'] = project_category(data['category'])
+    if 'categories' in data:
+        result['categories'] = [project_category(c) for c in data['categories']]
+    return result
+
+
+def project_media_items(data):
+    """Projection for MEDIA_URL responses"""
+
+    media = []
+    for md in data.get('media', []):
+        result = project_media(md)
+        # Only needed by the language dialog, and way too big to keep for every item in a category
+        result.update(pick(md, ('availableLanguages',)))
+        media.append(result)
+    return {'media': media}
+
+
+def project_languages(data):
+    """Projection for LANGUAGE_URL responses"""
+
+    return {'languages': [pick(l, LANGUAGE_FIELDS) for l in data.get('languages', [])]}
+
+
+class Cache(object):
+    def __init__(self, directory):
+        """Projected API data stored as one marshal file per URL
+
+        marshal is the fastest loader available in all Python versions Kodi ships,
+        but the format is Python version specific, so unreadable files are just ignored.
+        """
+        self.directory = directory
+
+    def path(self, url):
+        """Return the file name for an URL"""
+
+        # Py2: sha1 only accepts byte strings
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + '.bin')
+
+    def read(self, url):
+        """Return stored data for an URL and its age in seconds, or (None, None) if missing or unreadable"""
+
+        stored_url, data, timestamp = self.read_file(self.path(url))
+        if data is None:
+            return None, None
+        return data, time.time() - timestamp
+
+    def read_file(self, path):
+        """Return (url, data, timestamp) from a cache file, or (None, None, None) if it's unreadable"""
+
+        try:
+            with open(path, 'rb') as f:
+                entry = marshal.loads(f.read())
+            if entry[0] != FORMAT_VERSION:
+                return None, None, None
+            version, timestamp, url, data = entry
+        except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
+            return None, None, None
+        return url, data, timestamp
+
+    def files(self):
+        """Return a list of (path, modification time) for all cache files"""
+
+        result = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return result
+        for name in names:
+            if name.endswith('.bin'):
+                path = os.path.join(self.directory, name)
+                try:
+                    result.append((path, os.path.getmtime(path)))
+                except OSError:
+                    # Removed in between
+                    continue
+        return result
+
+    def load(self, url, max_age=None):
+        """Return stored data for an URL, or None if missing, unreadable or older than max_age seconds"""
+
+        data, age = self.read(url)
+        if max_age is not None and age is not None and age > max_age:
+            return None
+        return data
+
+    def lock(self, url):
+        """Return a FileLock for fetching an URL, so that only one process downloads it at a time
+
+        Waiting longer than a normal response takes is pointless, then it's better to make our own request.
+        """
+        return FileLock(self.path(url) + '.lock', timeout=20)
+
+    def save(self, url, data):
+        """Store data for an URL"""
+
+        atomic_write(self.path(url), marshal.dumps((FORMAT_VERSION, time.time(), url, data)))
@@ -0,0 +1,99 @@
+"""
+Fetching API data through the circuit breaker and the cache, shared by the plugin and the service
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import time
+
+from .breaker import CircuitOpenError
+
+try:
+    from urllib.error import HTTPError
+    from urllib.request import Request
+    from urllib.parse import urlparse
+except ImportError:
+    from urllib2 import Request, HTTPError
+    from urlparse import urlparse
+
+
+class ApiClient(object):
+    def __init__(self, cache, breaker, fetcher, log=None):
+        """Gets JSON data from jw.org, keeping the breaker and the cache up to date
+
+        :param cache: a cache.Cache
+        :param breaker: a breaker.CircuitBreaker
+        :param fetcher: a policy.Fetcher
+        :param log: function taking a string
+        """
+        self.cache = cache
+        self.breaker = breaker
+        self.fetcher = fetcher
+        self.log = log or (lambda msg: None)
+
+    def get_json(self, url):
+        """Fetch JSON data from an URL or a Request object and return it as a Python object
+
+        IOError (or a subclass) is raised on failure. Hosts that keep failing are skipped for a while,
+        which raises CircuitOpenError.
+        """
+        full_url = url.get_full_url() if isinstance(url, Request) else url
+        host = urlparse(full_url).netloc
+
+        if not self.breaker.allow(host):
+            raise CircuitOpenError(host)
+        try:
+            data = self.fetcher.fetch(url)
+        except IOError as e:
+            # A 4xx response means the server is alive and well
+            if isinstance(e, HTTPError) and e.code < 500:
+                self.breaker.success(host)
+            else:
+                self.breaker.failure(host)
+            raise
+        self.breaker.success(host)
+        return json.loads(data.decode('utf-8'))
+
+    def fetch_and_cache(self, url, projection, max_age=None, get_json=None):
+        """Fetch JSON data, project it, and store it in the cache
+
+        If another process (or thread) is already fetching the same URL, wait for it and use its result.
+
+        :param projection: function that strips the data down to the fields we use, before it's stored
+        :param max_age: also use cached data that is at most this many seconds old, instead of fetching
+        :param get_json: function taking an URL and returning data or None, defaults to self.get_json
+        :return: the projected data, or None if get_json returned None
+        """
+        started = time.time()
+        with self.cache.lock(url):
+            data, age = self.cache.read(url)
+            if data is not None:
+                if time.time() - age >= started:
+                    self.log('{} was fetched by another process'.format(url))
+                    return data
+                if max_age is not None and age <= max_age:
+                    return data
+
+            data = (get_json or self.get_json)(url)
+            if data is None:
+                return None
+            data = projection(data)
+            try:
+                self.cache.save(url, data)
+            except (IOError, OSError) as e:
+                self.log('could not cache {}: {}'.format(url, e))
+            return data
+
+    def warm(self, url, projection, max_age, fallback=True):
+        """Make sure there's data for an URL in the cache that is at most max_age seconds old, and return it
+
+        :param fallback: if the request fails, return old data from the cache instead of None
+        """
+        data = self.cache.load(url, max_age)
+        if data is not None:
+            return data
+        try:
+            return self.fetch_and_cache(url, projection, max_age)
+        except IOError as e:
+            self.log('{} failed: {}'.format(url, e))
+            return self.cache.load(url) if fallback else None
@@ -12,6 +12,39 @@ LANGUAGE_URL = API_BASE + '/languages/'
 TOKEN_URL = 'https://b.jw-cdn.org/tokens/jworg.jwt'
 SEARCH_URL = 'https://data.jw-api.org/search/query'
 
+# Seconds before cached API data is fetched again
+CACHE_TTL = 60 * 60
+LANGUAGE_CACHE_TTL = 24 * 60 * 60
+# Seconds that old cached data may be shown while it's being refreshed in the background
+STALE_TTL = 7 * 24 * 60 * 60
+
+# Seconds before the end of an item, when the service starts resolving the next item
+PREFETCH_BEFORE_END = 60
+# How much of the next file to download in advance
+PREFETCH_BYTES = 4 * 1024 * 1024
+# Seconds to spend on downloading those bytes, it's only worth it on a decent connection
+PREFETCH_TIMEOUT = 30
+
+# Maximum number of items in a widget
+WIDGET_LIMIT = 20
+# Seconds between the service refreshing the widget categories
+WIDGET_REFRESH_INTERVAL = 30 * 60
+# Seconds before the first retry of a failed widget refresh, doubling up to the refresh interval
+WIDGET_RETRY_DELAY = 60
+
+# Maximum total size of downloaded subtitles, in bytes
+SUBTITLE_CACHE_SIZE = 20 * 1024 * 1024
+# Seconds to wait for a subtitle download before starting playback with the remote URL instead
+# Only enough for a file that's already stored, a real download is left for next time
+SUBTITLE_WAIT = 0.3
+
+# Maximum number of search results
+SEARCH_LIMIT = 24
+# Seconds jw.org gets to add to local search results, before the results are shown without them
+SEARCH_EXTRA_WAIT = 2
+# Seconds between the service adding new cache files to the search index
+INDEX_INTERVAL = 60
+
 
 class AttributeProxy(object):
     """A class which runs a function when accessing its attributes
@@ -53,6 +86,15 @@ class Mode(object):
     PLAY = 'play'
     BROWSE = 'browse'
     STREAM = 'stream'
+    LATEST = 'widget_latest'
+    FEATURED = 'widget_featured'
+
+
+# Categories shown by the widget modes
+WIDGET_CATEGORIES = {
+    Mode.LATEST: 'LatestVideos',
+    Mode.FEATURED: 'FeaturedSetTopBoxVideos',
+}
 
 
 class SettingID(object):
@@ -67,6 +109,7 @@ class SettingID(object):
     START_WARNING = 'startupmsg'
     SEARCH_TRANSL = 'search_tr'
     REMEMBER_LANG = 'remember_lang'
+    PREFETCH = 'prefetch_start'
 
 
 class LocalizedStringID(AttributeProxy):
@@ -81,3 +124,4 @@ class LocalizedStringID(AttributeProxy):
     AUDIO_ONLY = 30024
     CONN_ERR = 30025
     NOT_AVAIL = 30027
+    OFFLINE = 30028
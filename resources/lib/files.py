@@ -0,0 +1,49 @@
+"""
+File writing that is safe when several processes and threads use the same files
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import os
+import threading
+
+
+def atomic_write(path, data, mode='wb'):
+    """Write a file under a temporary name first, then rename it, so a reader never sees half a file
+
+    The directory is created if needed. Every process and thread gets its own temporary name.
+
+    :param data: bytes, or a string if mode is 'w'
+    :param mode: mode for open()
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # Created by someone else in between
+            if not os.path.isdir(directory):
+                raise
+
+    tmp = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(tmp, mode) as f:
+            f.write(data)
+        replace_file(tmp, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def replace_file(src, dst):
+    """Rename a file, overwriting the destination"""
+
+    try:
+        os.replace(src, dst)
+    except AttributeError:
+        # Py2: rename can't overwrite on Windows
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
@@ -0,0 +1,168 @@
+"""
+A local search index over media metadata that is already in the cache
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import re
+import sqlite3
+
+from .constants import CATEGORY_URL, MEDIA_URL
+
+# Bump this when the schema changes, so that old indexes are rebuilt
+SCHEMA_VERSION = 2
+TABLES = ('media', 'terms', 'sources', 'files')
+SCHEMA = (
+    # One row per media item and language, data is the projected media JSON (see cache.project_media)
+    'CREATE TABLE IF NOT EXISTS media (key TEXT, lang TEXT, title TEXT, data TEXT, PRIMARY KEY (key, lang))',
+    'CREATE TABLE IF NOT EXISTS terms (term TEXT, key TEXT, lang TEXT, PRIMARY KEY (term, lang, key))',
+    # The cache files each media item was found in, an item is removed when it's gone from all of them
+    'CREATE TABLE IF NOT EXISTS sources (path TEXT, key TEXT, lang TEXT, PRIMARY KEY (path, key, lang))',
+    'CREATE INDEX IF NOT EXISTS sources_item ON sources (key, lang)',
+    # Cache files that have been indexed, so we only look at new and updated ones
+    'CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL)',
+)
+
+
+def tokenize(text):
+    """Split text into lower case words"""
+
+    return re.findall(r'\w+', (text or '').lower(), re.UNICODE)
+
+
+def lang_from_url(url):
+    """Return the language code of a category or media URL, or None"""
+
+    for prefix in (CATEGORY_URL, MEDIA_URL):
+        if url.startswith(prefix):
+            return re.split(r'[/?]', url[len(prefix):])[0] or None
+    return None
+
+
+def walk_media(data):
+    """Yield all media items in a projected CATEGORY_URL or MEDIA_URL response"""
+
+    categories = list(data.get('categories', []))
+    if 'category' in data:
+        categories.append(data['category'])
+    while categories:
+        c = categories.pop()
+        categories.extend(c.get('subcategories', []))
+        for md in c.get('media', []):
+            yield md
+    for md in data.get('media', []):
+        yield md
+
+
+class SearchIndex(object):
+    def __init__(self, path):
+        """An inverted index of titles and descriptions, stored in SQLite
+
+        :param path: database file
+        """
+        # Kodi may run the plugin and the service at the same time, wait for each other's writes
+        self.db = sqlite3.connect(path, timeout=10)
+        # Lock the database, so the plugin and the service don't both rebuild it
+        self.db.execute('BEGIN IMMEDIATE')
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            # Everything can be indexed again from the cache
+            for table in TABLES:
+                self.db.execute('DROP TABLE IF EXISTS ' + table)
+            self.db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def update(self, cache):
+        """Index cache files that are new or have changed since last time, and forget those that are gone
+
+        :param cache: a cache.Cache
+        :return: number of files indexed
+        """
+        indexed = dict(self.db.execute('SELECT path, mtime FROM files'))
+        count = 0
+        for path, mtime in cache.files():
+            if indexed.pop(path, None) == mtime:
+                continue
+            url, data, timestamp = cache.read_file(path)
+            lang = lang_from_url(url) if url else None
+            items = set()
+            if lang and isinstance(data, dict):
+                for md in walk_media(data):
+                    key = self.add(md, lang)
+                    if key:
+                        items.add((key, lang))
+            self.set_sources(path, items)
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?)', (path, mtime))
+            # Commit per file, so that searches in the plugin aren't blocked for long
+            self.db.commit()
+            count += 1
+
+        # What's left has been removed from the cache
+        for path in indexed:
+            self.set_sources(path, set())
+            self.db.execute('DELETE FROM files WHERE path = ?', (path,))
+            self.db.commit()
+        return count
+
+    def set_sources(self, path, items):
+        """Record which media items a cache file contains, and remove items that are no longer in any file
+
+        :param items: set of (key, lang)
+        """
+        old_items = set(self.db.execute('SELECT key, lang FROM sources WHERE path = ?', (path,)))
+        self.db.execute('DELETE FROM sources WHERE path = ?', (path,))
+        self.db.executemany('INSERT OR IGNORE INTO sources VALUES (?, ?, ?)', [(path, k, l) for k, l in items])
+        for key, lang in old_items - items:
+            if not self.db.execute('SELECT 1 FROM sources WHERE key = ? AND lang = ?', (key, lang)).fetchone():
+                self.db.execute('DELETE FROM media WHERE key = ? AND lang = ?', (key, lang))
+                self.db.execute('DELETE FROM terms WHERE key = ? AND lang = ?', (key, lang))
+
+    def add(self, md, lang):
+        """Add or replace a projected media item
+
+        :return: the key of the item, or None if it has none
+        """
+        key = md.get('languageAgnosticNaturalKey')
+        if not key:
+            return None
+        # Only needed by the language dialog, which does its own lookup
+        md = {k: v for k, v in md.items() if k != 'availableLanguages'}
+        self.db.execute('INSERT OR REPLACE INTO media VALUES (?, ?, ?, ?)',
+                        (key, lang, md.get('title'), json.dumps(md)))
+        self.db.execute('DELETE FROM terms WHERE key = ? AND lang = ?', (key, lang))
+        terms = set(tokenize(md.get('title')) + tokenize(md.get('description')))
+        self.db.executemany('INSERT OR IGNORE INTO terms VALUES (?, ?, ?)', [(t, key, lang) for t in terms])
+        return key
+
+    def search(self, query, lang, limit):
+        """Return projected media items where all words of the query match the start of a word
+
+        Items with matches in the title come first.
+        """
+        words = tokenize(query)
+        if not words:
+            return []
+
+        keys = None
+        for word in words:
+            # Prefix match, using the primary key index
+            rows = self.db.execute('SELECT key FROM terms WHERE lang = ? AND term >= ? AND term < ?',
+                                   (lang, word, word + '\uffff'))
+            matches = {row[0] for row in rows}
+            keys = matches if keys is None else keys & matches
+            if not keys:
+                return []
+
+        results = []
+        for key in keys:
+            row = self.db.execute('SELECT title, data FROM media WHERE key = ? AND lang = ?', (key, lang)).fetchone()
+            if row:
+                title_words = tokenize(row[0])
+                title_hits = sum(1 for w in words if any(t.startswith(w) for t in title_words))
+                results.append((-title_hits, row[0] or '', json.loads(row[1])))
+        results.sort(key=lambda r: (r[0], r[1]))
+        return [r[2] for r in results[:limit]]
@@ -0,0 +1,15 @@
+"""
+Helpers shared by the plugin and the service, that need Kodi
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+from kodi_six import xbmc, xbmcvfs, py2_decode
+
+
+def translate_path(path):
+    """Convert a special:// path to a real path"""
+
+    try:
+        return py2_decode(xbmcvfs.translatePath(path))  # Kodi v19
+    except AttributeError:
+        return py2_decode(xbmc.translatePath(path))
@@ -0,0 +1,173 @@
+"""
+Lock files, for coordinating plugin processes that Kodi runs at the same time
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import errno
+import os
+import random
+import threading
+import time
+
+# Locks held by the current thread, as path: [token, depth, event that stops the heartbeat]
+_held = threading.local()
+
+
+def _read_token(path):
+    """Return the contents of a lock file, or None if it's gone"""
+
+    try:
+        with open(path, 'rb') as f:
+            return f.read().decode('ascii', 'replace')
+    except (IOError, OSError):
+        return None
+
+
+def _pid_alive(token):
+    """Return False if the process that wrote a token is known to be dead
+
+    Kodi runs add-ons inside its own process, so this only catches locks left behind by an earlier
+    run of Kodi. Add-ons that were stopped while Kodi kept running are caught by the heartbeat instead.
+    """
+    # os.kill(pid, 0) would terminate the process on Windows
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(int(token.split('.')[0]), 0)
+    except (ValueError, AttributeError):
+        return True
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+def _take(path, token):
+    """Remove a lock file, but only if it contains the given token
+
+    The file is first renamed to a unique name, so nobody else can touch it while we check.
+    If it turns out to be someone else's, it's put back, unless a new lock has been taken already.
+
+    :return: True if the file was ours and is now removed
+    """
+    grabbed = '{}.{}.{}'.format(path, os.getpid(), random.getrandbits(32))
+    try:
+        os.rename(path, grabbed)
+    except OSError:
+        return False
+    if _read_token(grabbed) == token:
+        os.remove(grabbed)
+        return True
+    try:
+        # Unlike rename, link won't replace a lock that someone else has taken in between
+        os.link(grabbed, path)
+        os.remove(grabbed)
+    except AttributeError:
+        # Py2 on Windows: no link, and rename won't replace anything there anyway
+        try:
+            os.rename(grabbed, path)
+        except OSError:
+            os.remove(grabbed)
+    except OSError:
+        try:
+            os.remove(grabbed)
+        except OSError:
+            pass
+    return False
+
+
+class FileLock(object):
+    def __init__(self, path, timeout=30, stale=10):
+        """A lock that works across processes, to be used with the with statement
+
+        The lock can be taken again by the thread that holds it.
+        If it can't be taken within the timeout, we go ahead anyway, a duplicate request is better than a hang.
+
+        While the lock is held, a thread keeps touching the file. So a lock that hasn't been touched
+        for a while, or whose process is dead, was abandoned (like when Kodi killed the process).
+
+        :param path: the lock file
+        :param timeout: seconds to wait for the lock
+        :param stale: seconds without a touch before a lock is considered abandoned, less than timeout
+        """
+        self.path = path
+        self.timeout = timeout
+        self.stale = stale
+        self.acquired = False
+
+    def __enter__(self):
+        held = getattr(_held, 'locks', {})
+        _held.locks = held
+        if self.path in held:
+            held[self.path][1] += 1
+            self.acquired = True
+            return self
+
+        if not os.path.isdir(os.path.dirname(self.path)):
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError:
+                # Created by someone else in between
+                pass
+
+        token = '{}.{}.{}'.format(os.getpid(), threading.current_thread().ident, random.getrandbits(64))
+        deadline = time.time() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, token.encode('ascii'))
+                os.close(fd)
+                held[self.path] = [token, 1, self._start_heartbeat(token)]
+                self.acquired = True
+                return self
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    # Can't create lock files at all, so don't bother
+                    return self
+
+            owner = _read_token(self.path)
+            if owner is None:
+                # Released in between
+                continue
+            try:
+                abandoned = time.time() - os.path.getmtime(self.path) > self.stale or not _pid_alive(owner)
+            except OSError:
+                continue
+            if abandoned and _take(self.path, owner):
+                continue
+            if time.time() > deadline:
+                return self
+            time.sleep(0.05)
+
+    def _start_heartbeat(self, token):
+        """Touch the lock file regularly, so others can tell it's still in use
+
+        :return: an Event that stops the touching
+        """
+        stop = threading.Event()
+        path = self.path
+        interval = self.stale / 3
+
+        def beat():
+            while not stop.wait(interval):
+                if _read_token(path) != token:
+                    return
+                try:
+                    os.utime(path, None)
+                except OSError:
+                    return
+
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    def __exit__(self, *exc_info):
+        if not self.acquired:
+            return
+        self.acquired = False
+        entry = _held.locks[self.path]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _held.locks[self.path]
+            entry[2].set()
+            _take(self.path, entry[0])
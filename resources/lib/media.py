@@ -0,0 +1,69 @@
+"""
+Helpers for jw media metadata that don't depend on Kodi, so they can be shared with the service
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+from .constants import Query as Q, Mode as M, CATEGORY_URL
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+
+def preferred_media_file(files, video_res, subtitle_setting):
+    """Take an jw JSON array of files and metadata and return the most suitable file, or None
+
+    :param files: the 'files' array of a media item
+    :param video_res: preferred maximum video height
+    :param subtitle_setting: if hardcoded subtitles are preferred
+    """
+    # Rank media files depending on how they match certain criteria
+    # Video resolution will be converted to a rank between 2 and 10
+    resolution_not_too_big = 200
+    subtitles_matches_pref = 100
+
+    ranked = []
+    for f in files:
+        rank = 0
+        try:
+            # Grab resolution from label, eg. 360p, and remove the p
+            res = int(f.get('label')[:-1])
+        except (TypeError, ValueError):
+            try:
+                res = int(f.get('frameHeight', 0))
+            except (TypeError, ValueError):
+                res = 0
+        rank += res // 10
+        if 0 < res <= video_res:
+            rank += resolution_not_too_big
+        # 'subtitled' only applies to hardcoded video subtitles
+        if f.get('subtitled') == subtitle_setting:
+            rank += subtitles_matches_pref
+        ranked.append((rank, f))
+    # Only sort on rank, dicts can't be compared in Py3
+    ranked.sort(key=lambda r: r[0])
+
+    if ranked:
+        # [-1] The file with the highest rank, [1] the file, not the rank
+        return ranked[-1][1]
+    else:
+        return None
+
+
+def category_url(lang, key):
+    """Return the URL for a detailed category, the same for all callers so the cache is shared"""
+
+    return CATEGORY_URL + lang + '/' + key + '?&detailed=1'
+
+
+def media_key_from_plugin_url(url, plugin_id):
+    """Return the media key if the URL is a request to play something with this add-on, else None"""
+
+    parsed = urlparse(url)
+    if parsed.scheme != 'plugin' or parsed.netloc != plugin_id:
+        return None
+    query = parse_qs(parsed.query)
+    if query.get(Q.MODE) != [M.PLAY] or Q.LANGCODE in query:
+        return None
+    return query.get(Q.MEDIAKEY, [None])[0]
@@ -0,0 +1,307 @@
+"""
+Timeouts, retries and hedged requests for the different API endpoints
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import json
+import random
+import socket
+import threading
+import time
+
+from .constants import API_BASE, SEARCH_URL, TOKEN_URL
+from .files import atomic_write
+from .lock import FileLock
+
+try:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen, Request
+    from queue import Queue, Empty
+except ImportError:
+    from urllib2 import urlopen, Request, HTTPError
+    from Queue import Queue, Empty
+
+
+class DeadlineExceeded(socket.timeout):
+    """The response took longer than the read deadline"""
+
+
+class RequestPolicy(object):
+    def __init__(self, connect_timeout=5, read_timeout=15, retries=2, backoff=0.5, max_backoff=4,
+                 hedge=False, hedge_delay=1.5):
+        """Rules for how to make requests to an endpoint
+
+        :param connect_timeout: seconds to wait for a connection, and for each chunk of data
+        :param read_timeout: seconds to wait for the whole response
+        :param retries: number of extra attempts after network errors or 5xx responses
+        :param backoff: seconds to wait before the first retry, doubling for each retry
+        :param max_backoff: upper limit of the wait between retries
+        :param hedge: if True, send a duplicate request if the first is slower than usual (only for GET)
+        :param hedge_delay: seconds before the duplicate is sent, until we have enough statistics
+        """
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+
+    def backoff_delay(self, attempt):
+        """Seconds to wait before a retry, with "full jitter" so that clients don't retry in sync"""
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+# Endpoint name, URL prefix and policy, the first matching prefix is used
+ENDPOINTS = (
+    ('mediator', API_BASE, RequestPolicy(hedge=True)),
+    ('search', SEARCH_URL, RequestPolicy(retries=1)),
+    ('token', TOKEN_URL, RequestPolicy()),
+)
+DEFAULT_ENDPOINT = ('other', '', RequestPolicy(retries=0))
+
+
+class LatencyHistogram(object):
+    # Upper bounds of the buckets, in milliseconds, the last bucket is everything above
+    BOUNDS = (50, 100, 200, 400, 800, 1600, 3200, 6400, 12800)
+    # When a histogram has more samples than this, all counts are halved, so it keeps up with changes
+    MAX_SAMPLES = 1000
+    # Don't trust percentiles with less samples than this
+    MIN_SAMPLES = 20
+
+    def __init__(self, path):
+        """Response times per endpoint, stored as a JSON file that can be inspected by hand
+
+        Example: {"mediator": [0, 3, 25, 12, 2, 0, 0, 0, 0, 0]}
+
+        The file is read once. New samples are kept in memory until save() merges them into the file.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._saved = None
+        self._pending = {}
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _write(self, state):
+        try:
+            atomic_write(self.path, json.dumps(state), 'w')
+        except (IOError, OSError):
+            pass
+
+    def _empty(self):
+        return [0] * (len(self.BOUNDS) + 1)
+
+    def _counts(self, state, endpoint):
+        counts = state.get(endpoint)
+        if not counts or len(counts) != len(self.BOUNDS) + 1:
+            return self._empty()
+        return list(counts)
+
+    def _current(self):
+        """Return the saved histograms plus the samples that haven't been saved yet (call with _lock held)"""
+
+        if self._saved is None:
+            self._saved = self._read()
+        state = {}
+        for endpoint in set(self._saved) | set(self._pending):
+            counts = self._counts(self._saved, endpoint)
+            state[endpoint] = [a + b for a, b in zip(counts, self._pending.get(endpoint, self._empty()))]
+        return state
+
+    def record(self, endpoint, seconds):
+        """Add a response time to the histogram of an endpoint"""
+
+        ms = seconds * 1000
+        bucket = len(self.BOUNDS)
+        for i, bound in enumerate(self.BOUNDS):
+            if ms <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            self._pending.setdefault(endpoint, self._empty())[bucket] += 1
+
+    def save(self):
+        """Merge the new samples into the file
+
+        Other processes do the same, so the file is read again under a lock, right before writing.
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+
+        # Only held for a few milliseconds, so a lock that isn't touched for a couple of seconds was abandoned
+        with FileLock(self.path + '.lock', timeout=5, stale=2):
+            state = self._read()
+            for endpoint, new_counts in pending.items():
+                counts = [a + b for a, b in zip(self._counts(state, endpoint), new_counts)]
+                if sum(counts) > self.MAX_SAMPLES:
+                    counts = [c // 2 for c in counts]
+                state[endpoint] = counts
+            self._write(state)
+
+        with self._lock:
+            self._saved = state
+
+    def percentile(self, endpoint, fraction):
+        """Return the upper bound in seconds of the bucket containing the percentile, or None if unknown"""
+
+        with self._lock:
+            counts = self._current().get(endpoint)
+        if not counts or sum(counts) < self.MIN_SAMPLES:
+            return None
+        limit = sum(counts) * fraction
+        total = 0
+        for i, count in enumerate(counts):
+            total += count
+            if total >= limit:
+                if i < len(self.BOUNDS):
+                    return self.BOUNDS[i] / 1000
+                break
+        return None
+
+    def summary(self):
+        """Return a human readable description of all histograms"""
+
+        with self._lock:
+            state = self._current()
+        lines = []
+        for endpoint, counts in sorted(state.items()):
+            labels = ['<={}ms: {}'.format(b, c) for b, c in zip(self.BOUNDS, counts)]
+            labels.append('>{}ms: {}'.format(self.BOUNDS[-1], counts[-1]))
+            lines.append(endpoint + ' ' + ', '.join(labels))
+        return '\n'.join(lines)
+
+
+def _response_socket(response):
+    """Return the socket of a response from urlopen, or None if it can't be found"""
+
+    fp = getattr(response, 'fp', None)
+    # Py3: HTTPResponse > BufferedReader > SocketIO > socket
+    sock = getattr(getattr(fp, 'raw', None), '_sock', None)
+    if sock is None:
+        # Py2: addinfourl > socket._fileobject > HTTPResponse > socket._fileobject > socket
+        sock = getattr(getattr(getattr(fp, '_sock', None), 'fp', None), '_sock', None)
+    return sock if hasattr(sock, 'settimeout') else None
+
+
+class Fetcher(object):
+    def __init__(self, histogram, endpoints=ENDPOINTS, log=None):
+        """Makes requests according to the policy of each endpoint
+
+        :param histogram: a LatencyHistogram, for statistics and hedge delays
+        :param endpoints: list of (name, URL prefix, RequestPolicy)
+        :param log: function taking a string, for retry messages
+        """
+        self.histogram = histogram
+        self.endpoints = endpoints
+        self.log = log or (lambda msg: None)
+
+    def endpoint(self, url):
+        """Return (name, policy) for an URL"""
+
+        for name, prefix, policy in self.endpoints:
+            if url.startswith(prefix):
+                return name, policy
+        return DEFAULT_ENDPOINT[0], DEFAULT_ENDPOINT[2]
+
+    def fetch(self, url):
+        """Return the response body of an URL or a Request object as bytes
+
+        IOError (or a subclass) is raised if all attempts fail.
+        """
+        full_url = url.get_full_url() if isinstance(url, Request) else url
+        name, policy = self.endpoint(full_url)
+
+        attempt = 0
+        while True:
+            try:
+                if policy.hedge and (not isinstance(url, Request) or url.get_method() == 'GET'):
+                    return self._hedged_fetch(url, name, policy)
+                else:
+                    return self._timed_fetch(url, name, policy)
+            except IOError as e:
+                # Client errors won't go away by trying again
+                if isinstance(e, HTTPError) and e.code < 500 or attempt >= policy.retries:
+                    raise
+                delay = policy.backoff_delay(attempt)
+                self.log('{} failed ({}), retrying in {:.2f}s'.format(full_url, e, delay))
+                time.sleep(delay)
+                attempt += 1
+
+    def _timed_fetch(self, url, name, policy):
+        """Make one request with timeouts, and record the response time
+
+        The socket timeout is shortened before each read, so that a server that trickles data
+        can't keep us waiting past the read deadline.
+        """
+        start = time.time()
+        deadline = start + policy.read_timeout
+        response = urlopen(url, timeout=policy.connect_timeout)
+        try:
+            sock = _response_socket(response)
+            # Py3: read1 returns what has arrived, instead of waiting for the whole chunk
+            read = getattr(response, 'read1', None) or response.read
+            chunks = []
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise DeadlineExceeded('no complete response within {}s'.format(policy.read_timeout))
+                if sock:
+                    sock.settimeout(min(policy.connect_timeout, remaining))
+                chunk = read(16 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except socket.timeout as e:
+            if time.time() >= deadline and not isinstance(e, DeadlineExceeded):
+                raise DeadlineExceeded('no complete response within {}s'.format(policy.read_timeout))
+            raise
+        finally:
+            response.close()
+        self.histogram.record(name, time.time() - start)
+        return b''.join(chunks)
+
+    def _hedged_fetch(self, url, name, policy):
+        """Make a request, and send a duplicate if there's no response within the 95th percentile
+
+        The first successful response is returned. The slower request is left to finish in a daemon thread.
+        """
+        delay = self.histogram.percentile(name, 0.95) or policy.hedge_delay
+        results = Queue()
+
+        def worker():
+            try:
+                results.put((True, self._timed_fetch(url, name, policy)))
+            except Exception as e:
+                results.put((False, e))
+
+        def start():
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        started = 1
+        try:
+            ok, value = results.get(timeout=delay)
+        except Empty:
+            self.log('no response within {:.2f}s, sending hedged request'.format(delay))
+            start()
+            started = 2
+            ok, value = results.get()
+
+        if not ok and started == 2:
+            # One request failed, but the other may still succeed
+            ok, value = results.get()
+        if ok:
+            return value
+        raise value
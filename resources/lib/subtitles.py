@@ -0,0 +1,85 @@
+"""
+Subtitle files stored on disk by media key and language
+"""
+from __future__ import absolute_import, division, unicode_literals
+
+import hashlib
+import os
+import re
+
+from .files import atomic_write
+
+
+class SubtitleCache(object):
+    def __init__(self, directory, max_size):
+        """Downloaded subtitles, the least recently used are removed when the total size gets too big
+
+        :param directory: where to store the files
+        :param max_size: maximum total size in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    def path(self, media_key, lang, url):
+        """Return the file name for a subtitle
+
+        A short hash of the URL is included, so that updated subtitles are downloaded again.
+        """
+        # Py2: sha1 only accepts byte strings
+        url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()[:8]
+        name = re.sub(r'[^\w.-]', '_', media_key + '.' + lang)
+        return os.path.join(self.directory, name + '.' + url_hash + '.vtt')
+
+    def get(self, media_key, lang, url):
+        """Return the path of a stored subtitle, or None"""
+
+        path = self.path(media_key, lang, url)
+        try:
+            # Mark as recently used
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def download(self, media_key, lang, url, fetch):
+        """Return the path of a subtitle, downloading it if needed
+
+        :param fetch: function that takes an URL and returns bytes (or raises IOError)
+        """
+        path = self.get(media_key, lang, url)
+        if path:
+            return path
+
+        path = self.path(media_key, lang, url)
+        atomic_write(path, fetch(url))
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        """Remove the least recently used files until the total size is below the limit
+
+        :param keep: path of a file that must not be removed, like the one that was just downloaded
+        """
+
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.vtt'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+
+        total = sum(f[1] for f in files)
+        # Oldest first
+        for mtime, size, path in sorted(files):
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
@@ -0,0 +1,248 @@
+# Licensed under the Apache License, Version 2.0
+from __future__ import unicode_literals, division, print_function, absolute_import
+
+import os.path
+import sqlite3
+import time
+import traceback
+
+from kodi_six import xbmc, xbmcaddon, py2_decode
+
+from resources.lib.breaker import CircuitBreaker
+from resources.lib.cache import Cache, project_categories, project_media_items
+from resources.lib.client import ApiClient
+from resources.lib.constants import SettingID, MEDIA_URL, CACHE_TTL, PREFETCH_BEFORE_END, PREFETCH_BYTES
+from resources.lib.constants import PREFETCH_TIMEOUT
+from resources.lib.constants import WIDGET_CATEGORIES, WIDGET_REFRESH_INTERVAL, INDEX_INTERVAL, SUBTITLE_CACHE_SIZE
+from resources.lib.constants import WIDGET_RETRY_DELAY
+from resources.lib.index import SearchIndex
+from resources.lib.kodiutils import translate_path
+from resources.lib.media import category_url, preferred_media_file, media_key_from_plugin_url
+from resources.lib.policy import Fetcher, LatencyHistogram
+from resources.lib.subtitles import SubtitleCache
+
+try:
+    from urllib.request import urlopen, Request
+except ImportError:
+    from urllib2 import urlopen, Request
+
+
+def log(msg, level=xbmc.LOGDEBUG):
+    """Write to log file"""
+
+    for line in msg.splitlines():
+        xbmc.log(addon_id + ' service: ' + line, level)
+
+
+class UpNext(object):
+    def __init__(self, client, subtitle_cache):
+        """Resolves the next item in the playlist while the current one is playing
+
+        The media metadata and subtitles go into the same caches as the plugin uses, so when
+        Kodi asks the plugin to resolve the next item, there's nothing left to download.
+
+        :param client: the client.ApiClient, with the cache shared with the plugin
+        :param subtitle_cache: the subtitles.SubtitleCache shared with the plugin
+        """
+        self.client = client
+        self.subtitle_cache = subtitle_cache
+        self.player = xbmc.Player()
+        # Path of the last playlist item we prefetched, so we only do it once
+        self.last_path = None
+
+    def check(self):
+        """Prefetch the next playlist item if the current one is about to end"""
+
+        if not self.player.isPlaying():
+            return
+        try:
+            remaining = self.player.getTotalTime() - self.player.getTime()
+        except RuntimeError:
+            # Stopped in between
+            return
+        if remaining > PREFETCH_BEFORE_END:
+            return
+
+        playlist = xbmc.PlayList(xbmc.PLAYLIST_MUSIC if self.player.isPlayingAudio() else xbmc.PLAYLIST_VIDEO)
+        position = playlist.getposition()
+        if position < 0 or position + 1 >= playlist.size():
+            return
+        path = py2_decode(playlist[position + 1].getPath())
+        if path == self.last_path:
+            return
+        self.last_path = path
+        self.prefetch(path)
+
+    def prefetch(self, path):
+        """Resolve a playlist item and optionally download the start of the file"""
+
+        # Settings may have changed since last time
+        settings = xbmcaddon.Addon()
+        video_res = [1080, 720, 480, 360, 240][int(settings.getSetting(SettingID.RESOLUTION))]
+        subtitle_setting = settings.getSetting(SettingID.SUBTITLES) == 'true'
+        global_lang = settings.getSetting(SettingID.LANGUAGE) or 'E'
+
+        media_key = media_key_from_plugin_url(path, addon_id)
+        if media_key:
+            log('resolving next item {}'.format(media_key), xbmc.LOGINFO)
+            # Same requests as resolve_media will make
+            one_time_lang = settings.getSetting(SettingID.LANG_NEXT)
+            data = self.client.warm(MEDIA_URL + (one_time_lang or global_lang) + '/' + media_key,
+                                    project_media_items, CACHE_TTL)
+            try:
+                f = preferred_media_file(data['media'][0].get('files', []), video_res, subtitle_setting)
+                url = f['progressiveDownloadURL']
+            except (TypeError, KeyError, IndexError):
+                return
+            self.download_subtitles(media_key, one_time_lang or global_lang, f)
+
+            if one_time_lang and one_time_lang != global_lang:
+                data = self.client.warm(MEDIA_URL + global_lang + '/' + media_key, project_media_items, CACHE_TTL)
+                try:
+                    self.download_subtitles(media_key, global_lang, data['media'][0]['files'][0])
+                except (TypeError, KeyError, IndexError):
+                    pass
+        elif path.startswith('http'):
+            # Shuffled categories are put in the playlist already resolved
+            url = path
+        else:
+            return
+
+        if settings.getSetting(SettingID.PREFETCH) == 'true':
+            self.preload(url)
+
+    def preload(self, url):
+        """Download the start of a media file and throw it away
+
+        Kodi's player makes its own connection, so this only helps if the CDN edge didn't have the file cached.
+        Not done through the fetcher, since megabytes of video would spoil the response time statistics.
+        """
+        log('preloading start of {}'.format(url))
+        start = time.time()
+        try:
+            response = urlopen(Request(url, headers={'Range': 'bytes=0-{}'.format(PREFETCH_BYTES - 1)}),
+                               timeout=PREFETCH_TIMEOUT)
+            try:
+                received = 0
+                while received < PREFETCH_BYTES and time.time() - start < PREFETCH_TIMEOUT:
+                    chunk = response.read(64 * 1024)
+                    if not chunk:
+                        break
+                    received += len(chunk)
+            finally:
+                response.close()
+        except IOError:
+            log(traceback.format_exc(), xbmc.LOGWARNING)
+
+    def download_subtitles(self, media_key, lang, f):
+        """Store the subtitles of a media file in the subtitle cache, if it has any"""
+
+        url = (f.get('subtitles') or {}).get('url')
+        if not url:
+            return
+        try:
+            self.subtitle_cache.download(media_key, lang, url, self.client.fetcher.fetch)
+        except (IOError, OSError):
+            log(traceback.format_exc(), xbmc.LOGWARNING)
+
+
+class WidgetRefresher(object):
+    def __init__(self, warm):
+        """Keeps the categories used by widgets in the cache, so widgets can render without network
+
+        :param warm: function taking an URL, projection, max age and fallback, like ApiClient.warm
+        """
+        self.warm = warm
+        self.last_refresh = 0
+        self.last_lang = None
+        # After a failure: when to try again, and how long to wait after the next failure
+        self.next_attempt = 0
+        self.retry_delay = WIDGET_RETRY_DELAY
+
+    def check(self):
+        """Refresh the widget categories if it's time, or if the language has changed"""
+
+        global_lang = xbmcaddon.Addon().getSetting(SettingID.LANGUAGE) or 'E'
+        if time.time() - self.last_refresh < WIDGET_REFRESH_INTERVAL and global_lang == self.last_lang:
+            return
+        if time.time() < self.next_attempt:
+            return
+
+        ok = True
+        for key in WIDGET_CATEGORIES.values():
+            log('refreshing widget category {}'.format(key))
+            # Half the interval, or data that the plugin saved just before would delay the refresh a whole round
+            data = self.warm(category_url(global_lang, key), project_categories,
+                             max_age=WIDGET_REFRESH_INTERVAL / 2, fallback=False)
+            if data is None:
+                ok = False
+
+        if ok:
+            self.last_refresh = time.time()
+            self.last_lang = global_lang
+            self.retry_delay = WIDGET_RETRY_DELAY
+        else:
+            log('widget refresh failed, retrying in {}s'.format(self.retry_delay))
+            self.next_attempt = time.time() + self.retry_delay
+            self.retry_delay = min(self.retry_delay * 2, WIDGET_REFRESH_INTERVAL)
+
+
+class Indexer(object):
+    def __init__(self, cache, path):
+        """Adds new cache files to the local search index, so the plugin never has to do it
+
+        :param cache: the cache.Cache shared with the plugin
+        :param path: search index database file
+        """
+        self.cache = cache
+        self.path = path
+        self.last_update = 0
+
+    def check(self):
+        """Update the index if it's time"""
+
+        if time.time() - self.last_update < INDEX_INTERVAL:
+            return
+        self.last_update = time.time()
+
+        try:
+            index = SearchIndex(self.path)
+            try:
+                count = index.update(self.cache)
+            finally:
+                index.close()
+        except sqlite3.Error:
+            log(traceback.format_exc(), xbmc.LOGWARNING)
+            return
+        if count:
+            log('indexed {} cache files for search'.format(count))
+
+
+if __name__ == '__main__':
+    addon = xbmcaddon.Addon()
+    addon_id = addon.getAddonInfo('id')
+
+    # The same files as the plugin uses
+    profile_dir = translate_path(addon.getAddonInfo('profile'))
+    histogram = LatencyHistogram(os.path.join(profile_dir, 'latency.json'))
+    client = ApiClient(Cache(os.path.join(profile_dir, 'cache')),
+                       CircuitBreaker(os.path.join(profile_dir, 'breaker.json')),
+                       Fetcher(histogram, log=log), log=log)
+    subtitle_cache = SubtitleCache(os.path.join(profile_dir, 'subtitles'), SUBTITLE_CACHE_SIZE)
+
+    monitor = xbmc.Monitor()
+    up_next = UpNext(client, subtitle_cache)
+    widgets = WidgetRefresher(client.warm)
+    indexer = Indexer(client.cache, os.path.join(profile_dir, 'search.db'))
+
+    # Poll a few times per minute, the prefetch window is much longer than that
+    while not monitor.waitForAbort(5):
+        try:
+            up_next.check()
+            widgets.check()
+            indexer.check()
+            # Does nothing unless there were requests
+            histogram.save()
+        except Exception:
+            # Keep the service alive, whatever happens
+            log(traceback.format_exc(), xbmc.LOGERROR)